@@ -4,13 +4,7 @@ import errno
 import sys
 from typing import List
 
-import pavilion.series.errors
-from pavilion import cmd_utils
 from pavilion import output
-from pavilion.series.series import TestSeries
-from pavilion.series_config import generate_series_config
-from pavilion.status_utils import print_from_tests
-from pavilion.test_run import TestRun
 from .base_classes import Command
 
 
@@ -113,6 +107,16 @@ class RunCommand(Command):
         :param pav_cfg: The pavilion configuration.
         :param args: The parsed command line argument object.
         """
+
+        # These are imported here rather than at the module level, as they're only needed
+        # when actually running tests (and not for 'pav run -h' or argument errors).
+        # pylint: disable=import-outside-toplevel
+        from pavilion import cmd_utils
+        from pavilion.series.errors import TestSeriesError
+        from pavilion.series.series import TestSeries
+        from pavilion.series_config import generate_series_config
+        from pavilion.status_utils import print_from_tests
+
         # 1. Resolve the test configs
         #   - Get sched vars from scheduler.
         #   - Compile variables.
@@ -163,11 +167,11 @@ class RunCommand(Command):
                 local_builds_only=local_builds_only,
                 verbosity=args.build_verbosity,
                 outfile=self.outfile)
-            self.last_tests = list(series_obj.tests.values())
-        except pavilion.series.errors.TestSeriesError as err:
-            self.last_tests = list(series_obj.tests.values())
+        except TestSeriesError as err:
             output.fprint(self.errfile, err, color=output.RED)
             return errno.EAGAIN
+        finally:
+            self.last_tests = list(series_obj.tests.values())
 
         if report_status:
             print_from_tests(
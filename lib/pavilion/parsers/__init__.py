@@ -16,14 +16,25 @@ The exception to this is result evaluation strings, which are interpreted
 directly as a ResultExpression.
 """
 
+import atexit
+import bisect
+import functools
+import hashlib
+import os
+import pickle
 import re
-from typing import List
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Tuple, Union
 
 import lark as _lark
-from .common import ParserValueError
+from pavilion.deferred import DeferredVariable
+from .common import ParserValueError, cache_dir
 from .expressions import (get_expr_parser, EvaluationExprTransformer,
                           VarRefVisitor)
-from .strings import get_string_parser, StringTransformer, should_parse
+from .strings import (get_string_parser, StringTransformer, should_parse,
+                      STRING_GRAMMAR)
 
 
 class ErrorCat:
@@ -72,6 +83,10 @@ BAD_EXAMPLES = [
               'hello(1, 12.3']),
 ]
 
+# Used by match_examples to compare the unexpected characters of two errors.
+_WORD_RE = re.compile(r'\w+')
+_WS_RE = re.compile(r'\s+')
+
 NO_MATCH_EXAMPLE = ErrorCat(
     'Unknown syntax error. Please report at https://github.com/hpc/pavilion2/issues',
     [])
@@ -90,7 +105,213 @@ class StringParserError(ValueError):
         return "\n".join([self.message, self.context])
 
 
-_TREE_CACHE = {}
+# The maximum number of parse trees to keep in memory.
+TREE_CACHE_SIZE = 4096
+
+# Parse trees are also cached on disk, so that each Pavilion invocation
+# doesn't have to re-parse the same test config strings.
+TREE_CACHE_NAME = 'string_trees.pkl'
+# The maximum number of trees to keep in the on-disk cache. The most
+# recently parsed trees are kept.
+TREE_CACHE_MAX = 10000
+
+# Pickled trees, by text, loaded from the on-disk cache.
+_DISK_TREES = None  # type: Dict[str, bytes]
+# Trees parsed during this invocation that need to be saved. Only the newest
+# TREE_CACHE_MAX of these could be saved anyway, so older ones are dropped.
+# They're pickled when saved, rather than when parsed.
+_NEW_TREES = OrderedDict()  # type: Dict[str, _lark.Tree]
+
+
+def _grammar_hash() -> str:
+    """Return a hash that identifies the grammar (and lark version) that
+    produced a set of cached trees."""
+
+    sha = hashlib.sha1()
+    sha.update(STRING_GRAMMAR.encode())
+    sha.update(_lark.__version__.encode())
+    return sha.hexdigest()
+
+
+def _tree_cache_path() -> Union[Path, None]:
+    """Return the path to the on-disk tree cache, or None if there's no usable
+    cache directory."""
+
+    cache = cache_dir()
+    return None if cache is None else cache/TREE_CACHE_NAME
+
+
+def _load_tree_cache(path: Union[Path, None]) -> Dict[str, bytes]:
+    """Load the pickled trees from the given on-disk cache file. Any errors,
+    trees made with a different grammar, or a file that someone other than the
+    current user could have written give an empty cache."""
+
+    if path is None:
+        return {}
+
+    try:
+        with path.open('rb') as cache_file:
+            # Unpickling can run arbitrary code, so only trust our own files.
+            file_stat = os.fstat(cache_file.fileno())
+            if file_stat.st_uid != os.getuid() or file_stat.st_mode & 0o022:
+                return {}
+
+            cache = pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+            ImportError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get('grammar') != _grammar_hash():
+        return {}
+
+    return cache.get('trees', {})
+
+
+def _save_tree_cache():
+    """Merge the trees parsed during this invocation into the on-disk cache.
+    The cache is only an optimization, so write failures are ignored."""
+
+    if not _NEW_TREES:
+        return
+
+    cache_path = _tree_cache_path()
+    if cache_path is None:
+        _NEW_TREES.clear()
+        return
+
+    # Re-read the cache, as other Pavilion instances may have updated it.
+    trees = _load_tree_cache(cache_path)
+    for text, tree in _NEW_TREES.items():
+        trees[text] = pickle.dumps(tree)
+    _NEW_TREES.clear()
+
+    if len(trees) > TREE_CACHE_MAX:
+        keys = list(trees.keys())[-TREE_CACHE_MAX:]
+        trees = {key: trees[key] for key in keys}
+
+    tmp_path = None
+    try:
+        tmp_file = tempfile.NamedTemporaryFile(
+            'wb', suffix='.tmp', dir=cache_path.parent.as_posix(), delete=False)
+        tmp_path = tmp_file.name
+        with tmp_file:
+            pickle.dump({'grammar': _grammar_hash(), 'trees': trees}, tmp_file)
+        os.replace(tmp_path, cache_path.as_posix())
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+@functools.lru_cache(maxsize=TREE_CACHE_SIZE)
+def _get_tree(text: str) -> _lark.Tree:
+    """Get the string parser tree for the given text. The most recently
+    used trees are kept in memory, and the on-disk cache is checked before
+    actually parsing."""
+
+    global _DISK_TREES  # pylint: disable=global-statement
+
+    if _DISK_TREES is None:
+        _DISK_TREES = _load_tree_cache(_tree_cache_path())
+
+    tree = None
+    pickled_tree = _DISK_TREES.get(text)
+    if pickled_tree is not None:
+        try:
+            tree = pickle.loads(pickled_tree)
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, ValueError):
+            tree = None
+
+    if tree is None:
+        tree = get_string_parser().parse(text)
+        # New trees are saved to the on-disk cache at exit.
+        if not _NEW_TREES:
+            atexit.register(_save_tree_cache)
+        _NEW_TREES[text] = tree
+        if len(_NEW_TREES) > TREE_CACHE_MAX:
+            _NEW_TREES.popitem(last=False)
+
+    return tree
+
+
+# Resolved string values, keyed by the text and the values of the variables
+# it uses. See _value_cache_key().
+_VALUE_CACHE = OrderedDict()
+# The variables used by each text, or None if its value can't be cached.
+_TEXT_VARS = OrderedDict()
+# The maximum number of entries in each of the above. The oldest are evicted
+# first.
+VALUE_CACHE_MAX = 10000
+
+
+def _text_vars(text: str, tree: _lark.Tree) -> Union[List[str], None]:
+    """Return the variables referenced by the given parsed string. Returns
+    None if the value of the string can't be cached, because it calls functions
+    (which may not be pure) or has bad expressions."""
+
+    if text in _TEXT_VARS:
+        return _TEXT_VARS[text]
+
+    used_vars = []
+    visitor = VarRefVisitor()
+    for expr_tree in tree.find_data('expr'):
+        # Copy the children, as the expr production consumes the format spec.
+        expr = StringTransformer.expr(list(expr_tree.children))
+        if expr.type != StringTransformer.EXPRESSION:
+            continue
+
+        try:
+            expr_tree = StringTransformer.parse_expr(expr)
+        except (_lark.UnexpectedInput, ParserValueError):
+            used_vars = None
+            break
+
+        if any(expr_tree.find_data('function_call')):
+            used_vars = None
+            break
+
+        used_vars.extend(visitor.visit(expr_tree))
+
+    _TEXT_VARS[text] = used_vars
+    if len(_TEXT_VARS) > VALUE_CACHE_MAX:
+        _TEXT_VARS.popitem(last=False)
+
+    return used_vars
+
+
+def _value_cache_key(text: str, tree: _lark.Tree, var_man) -> Union[tuple, None]:
+    """Return a key for the value cache that captures everything the resolved
+    value of text depends on: the text itself and all values (and deferred
+    status) of each variable it uses. Returns None if the value can't be
+    cached."""
+
+    used_vars = _text_vars(text, tree)
+    if used_vars is None:
+        return None
+
+    key = [text]
+    for var_name in used_vars:
+        try:
+            var_set, var, _, _ = var_man.resolve_key(var_name)
+            var_list = var_man.variable_sets[var_set].data[var]
+        except KeyError:
+            return None
+
+        if isinstance(var_list, DeferredVariable):
+            values = None
+        else:
+            values = tuple(tuple(sub_var.data.items())
+                           for sub_var in var_list.data)
+
+        deferred = tuple(sorted(str(def_key) for def_key in var_man.deferred
+                                if def_key[:2] == (var_set, var)))
+
+        key.append((var_set, var, values, deferred))
+
+    return tuple(key)
 
 
 def parse_text(text, var_man) -> str:
@@ -107,33 +328,39 @@ def parse_text(text, var_man) -> str:
     if not should_parse(text):
         return text
 
-    parser = get_string_parser()
     transformer = StringTransformer(var_man)
 
     def parse_fn(txt):
         """Shorthand for parsing text."""
 
-        tree = _TREE_CACHE.get(txt)
-        if tree is None:
-            tree = parser.parse(txt)
-            _TREE_CACHE[txt] = tree
-
-        return transformer.transform(tree)
+        return transformer.transform(_get_tree(txt))
 
+    cache_key = None
     try:
+        tree = _get_tree(text)
+        cache_key = _value_cache_key(text, tree, var_man)
+        if cache_key is not None and cache_key in _VALUE_CACHE:
+            return _VALUE_CACHE[cache_key]
+
         # On the surface it may seem that parsing and transforming should be
         # separate steps with their own errors, but expressions are parsed
         # as part of the transformation and may raise their own parse errors.
-        value = parse_fn(text)
+        value = transformer.transform(tree)
     except (_lark.UnexpectedCharacters, _lark.UnexpectedToken) as err:
         # Try to figure out why the error happened based on examples.
-        err_type = match_examples(err, parse_fn, BAD_EXAMPLES, text)
+        err_type = match_examples(err, parse_fn, BAD_EXAMPLES, text,
+                                  cache_key='string')
         raise StringParserError(err_type, err.get_context(text))
     except ParserValueError as err:
         # These errors are already really specific. We don't have to
         # figure them out.
         raise StringParserError(str(err), err.get_context(text))
 
+    if cache_key is not None:
+        _VALUE_CACHE[cache_key] = value
+        if len(_VALUE_CACHE) > VALUE_CACHE_MAX:
+            _VALUE_CACHE.popitem(last=False)
+
     return value
 
 
@@ -149,7 +376,8 @@ def check_expression(expr: str) -> List[str]:
         tree = parser.parse(expr)
     except (_lark.UnexpectedCharacters, _lark.UnexpectedToken) as err:
         # Try to figure out why the error happened based on examples.
-        err_type = match_examples(err, parser.parse, BAD_EXAMPLES, expr)
+        err_type = match_examples(err, parser.parse, BAD_EXAMPLES, expr,
+                                  cache_key='expr')
         raise StringParserError(
             "{}:\n{}".format(err_type, err.get_context(expr)),
             err.get_context(expr))
@@ -160,7 +388,51 @@ def check_expression(expr: str) -> List[str]:
     return vars_used
 
 
-def match_examples(exc, parse_fn, examples, text):
+# The errors produced by each example, by parser type. See _example_errors().
+_EXAMPLE_ERRORS = {}
+
+
+def _example_errors(parse_fn, examples, cache_key=None) \
+        -> List[Tuple[ErrorCat, str, Union[_lark.UnexpectedInput, None]]]:
+    """Parse each of the given error examples, and return a list of
+    (example, example_text, error) tuples. The error is None if the
+    example text didn't fail to parse.
+
+    :param parse_fn: A lark parser function.
+    :param list[ErrorCat] examples:
+    :param cache_key: The example errors depend only on the kind of parser
+        used, not the data given to it. If a key is given, the results
+        are computed once and stored under that key.
+    """
+
+    if cache_key is not None:
+        key = (cache_key, id(examples))
+        if key in _EXAMPLE_ERRORS:
+            return _EXAMPLE_ERRORS[key]
+
+    ex_errors = []
+    for example in examples:
+        for ex_text in example.examples:
+            try:
+                parse_fn(ex_text)
+            except (_lark.UnexpectedCharacters, _lark.UnexpectedToken) as err:
+                ex_errors.append((example, ex_text, err))
+            except ParserValueError:
+                # Examples should only raise Token or UnexpectedChar errors.
+                # ParserValue errors already come with a useful message.
+                raise RuntimeError(
+                    "Invalid failure example in string_parsers: '{}'"
+                    .format(ex_text))
+            else:
+                ex_errors.append((example, ex_text, None))
+
+    if cache_key is not None:
+        _EXAMPLE_ERRORS[key] = ex_errors
+
+    return ex_errors
+
+
+def match_examples(exc, parse_fn, examples, text, cache_key=None):
     """Given a parser instance and a dictionary mapping some label with
         some malformed syntax examples, it'll return the label for the
         example that bests matches the current error.
@@ -169,89 +441,71 @@ def match_examples(exc, parse_fn, examples, text):
     :param parse_fn: A lark parser function.
     :param list[ErrorCat] examples:
     :param text: The text that triggered the error.
+    :param cache_key: Cache the example errors for this kind of parse_fn
+        under this key.
     :return:
     """
 
-    word_re = re.compile(r'\w+')
-    ws_re = re.compile(r'\s+')
-
     if not hasattr(exc, 'state'):
         return None
 
-    err_pos = exc.pos_in_stream + 1
-
-    # Try to find the smallest subset of text that produces the error.
-    err_string = text
-    while err_pos <= len(text):
-        try:
-            parse_fn(text[:err_pos])
-        except (_lark.UnexpectedCharacters, _lark.UnexpectedToken) as err:
-            if err.state == exc.state:
-                err_string = text[exc.pos_in_stream:err_pos]
-        err_pos += 1
-
     closest_dist = 2.0
     closest_example = NO_MATCH_EXAMPLE
     closest_err = None
     closest_ex = None
 
     # Find an example error that fails at the same parser state.
-    for example in examples:
-        for ex_text in example.examples:
-            try:
-                parse_fn(ex_text)
-            except _lark.UnexpectedCharacters as err:
-                if not isinstance(exc, _lark.UnexpectedCharacters):
-                    continue
-
-                # Both the example and the original error got unexpected
-                # characters in the stream. If the unexpected characters
-                # are roughly the same, call it an exact match.
-                if (ex_text[err.pos_in_stream] == text[exc.pos_in_stream] or
-                        # Call it exact if they're both alpha-numeric
-                        re_compare(ex_text[err.pos_in_stream:],
-                                   text[exc.pos_in_stream], word_re) or
-                        # Or both whitespace
-                        re_compare(ex_text[err.pos_in_stream:],
-                                   text[exc.pos_in_stream], ws_re)):
-                    return example.message
-
-            except _lark.UnexpectedToken as err:
-                if not isinstance(exc, _lark.UnexpectedToken):
-                    continue
-
-                # For token errors, check that the state and next token match
-                # If just the state matches, we'll call it a partial match
-                # and look for something better.
-
-                # We annotate the errors from the expression parser, so we don't
-                # get confused by similar state stacks that happen to have been labeled
-                # in a similar way.
-                if not hasattr(err, 'expr_error') == hasattr(exc, 'expr_error'):
-                    continue
-
-                if err.state == exc.state and err.token == exc.token:
-                    # Try exact match first
-                    return example.message
-
-                else:
-                    stack1 = list(err.state.state_stack)
-                    stack2 = list(exc.state.state_stack)
-                    dist = state_stack_dist(stack1, stack2) + 1
-                    if exc.token.type == err.token.type:
-                        dist -= 1
-                    if dist <= closest_dist:
-                        closest_err = err
-                        closest_dist = dist
-                        closest_example = example
-                        closest_ex = ex_text
+    for example, ex_text, err in _example_errors(parse_fn, examples, cache_key):
+        if isinstance(err, _lark.UnexpectedCharacters):
+            if not isinstance(exc, _lark.UnexpectedCharacters):
+                continue
+
+            # Both the example and the original error got unexpected
+            # characters in the stream. If the unexpected characters
+            # are roughly the same, call it an exact match.
+            if (ex_text[err.pos_in_stream] == text[exc.pos_in_stream] or
+                    # Call it exact if they're both alpha-numeric
+                    re_compare(ex_text[err.pos_in_stream:],
+                               text[exc.pos_in_stream], _WORD_RE) or
+                    # Or both whitespace
+                    re_compare(ex_text[err.pos_in_stream:],
+                               text[exc.pos_in_stream], _WS_RE)):
+                return example.message
+
+        elif isinstance(err, _lark.UnexpectedToken):
+            if not isinstance(exc, _lark.UnexpectedToken):
+                continue
+
+            # For token errors, check that the state and next token match
+            # If just the state matches, we'll call it a partial match
+            # and look for something better.
+
+            # We annotate the errors from the expression parser, so we don't
+            # get confused by similar state stacks that happen to have been labeled
+            # in a similar way.
+            if not hasattr(err, 'expr_error') == hasattr(exc, 'expr_error'):
+                continue
+
+            if err.state == exc.state and err.token == exc.token:
+                # Try exact match first
+                return example.message
 
-            except ParserValueError:
-                # Examples should only raise Token or UnexpectedChar errors.
-                # ParserValue errors already come with a useful message.
-                raise RuntimeError(
-                    "Invalid failure example in string_parsers: '{}'"
-                    .format(ex_text))
+            else:
+                stack1 = list(err.state.state_stack)
+                stack2 = list(exc.state.state_stack)
+                dist = state_stack_dist(stack1, stack2) + 1
+                if exc.token.type == err.token.type:
+                    dist -= 1
+                if dist <= closest_dist:
+                    closest_err = err
+                    closest_dist = dist
+                    closest_example = example
+                    closest_ex = ex_text
+
+                # Same state stack and token type. That's as good as a
+                # match gets short of an exact one, so stop looking.
+                if closest_dist == 0:
+                    break
 
     return closest_example.message
 
@@ -285,17 +539,20 @@ def _state_stack_dist(stack1: List, stack2: List) -> int:
     The 'perfect' algorithm for this sort of matching is NP-complete.
     """
 
+    # Index the positions of each state in stack2, so we can jump directly to
+    # the next occurrence of a state rather than scanning for it.
+    positions = {}
+    for pos, state in enumerate(stack2):
+        positions.setdefault(state, []).append(pos)
+
     dist = 0
     ptr2 = 0
 
-    for ptr1 in range(len(stack1)):
-        tmp_ptr = ptr2
-        while tmp_ptr < len(stack2):
-            if stack1[ptr1] == stack2[tmp_ptr]:
-                ptr2 = tmp_ptr + 1
-                break
-            else:
-                tmp_ptr += 1
+    for state in stack1:
+        state_positions = positions.get(state, [])
+        idx = bisect.bisect_left(state_positions, ptr2)
+        if idx < len(state_positions):
+            ptr2 = state_positions[idx] + 1
         else:
             dist += 1
 
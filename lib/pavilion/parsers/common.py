@@ -1,9 +1,75 @@
 """This module contains base classes and exceptions shared by the various
 Pavilion parsers."""
 
+import getpass
+import os
+import tempfile
+from pathlib import Path
+from typing import Union
+
 import lark
 
 
+def _default_cache_dir() -> Path:
+    """Return the directory the parser caches should go in. This follows the
+    XDG base directory spec, and is deliberately not under ~/.pavilion, which
+    is a config directory."""
+
+    xdg_cache = os.environ.get('XDG_CACHE_HOME')
+    if xdg_cache:
+        return Path(xdg_cache)/'pavilion'
+
+    try:
+        return (Path('~')/'.cache').expanduser()/'pavilion'
+    except (OSError, RuntimeError):
+        # The user has no discernible home directory.
+        pass
+
+    try:
+        user = getpass.getuser()
+    except (KeyError, OSError):
+        # Nor a name (the uid may not have a passwd entry).
+        user = str(os.getuid())
+
+    return Path(tempfile.gettempdir())/user/'pavilion_cache'
+
+
+# Parser tables and parse trees are cached here between Pavilion invocations.
+# When None, the default location is found when the cache is first used.
+CACHE_DIR = None  # type: Union[Path, None]
+
+
+def cache_dir() -> Union[Path, None]:
+    """Return the (created) parser cache directory. Returns None if it can't be
+    found or created, or if it isn't private to the current user. The caches
+    are pickles, so we must never load them from where others could write."""
+
+    try:
+        cache = CACHE_DIR if CACHE_DIR is not None else _default_cache_dir()
+        cache.mkdir(mode=0o700, parents=True, exist_ok=True)
+        dir_stat = cache.stat()
+    except (OSError, RuntimeError, KeyError):
+        return None
+
+    if dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o022:
+        return None
+
+    return cache
+
+
+def parser_cache(name: str) -> Union[str, bool]:
+    """Return the path Lark should use to cache the tables for the named
+    parser. Lark itself invalidates the cache file when the grammar, parser
+    options, or lark version change. Returns False (don't cache) if there's
+    no usable cache directory."""
+
+    cache = cache_dir()
+    if cache is None:
+        return False
+
+    return (cache/'{}_parser.lark_cache'.format(name)).as_posix()
+
+
 class ParserValueError(lark.LarkError):
     """A value error that contains the problematic token and its position."""
 
@@ -23,6 +89,47 @@ class PavTransformer(lark.Transformer):
     tokens to better track where in the syntax things went wrong,
     and more carefully handles exceptions."""
 
+    def transform(self, tree: lark.Tree):
+        """Transform the given tree, and return the final result.
+
+        Replaces the original, which recurses through a pair of generator
+        based helpers for every subtree. This walks the tree with an explicit
+        stack instead, calling the user functions in exactly the same
+        (post-order) sequence."""
+
+        visit_tokens = self.__visit_tokens__
+        call_tree = self._call_userfunc
+        call_token = self._call_userfunc_token
+        tree_type = lark.Tree
+        token_type = lark.Token
+        discard = lark.visitors.Discard
+
+        # Each entry is the subtree, an iterator over its remaining children,
+        # and the already transformed children.
+        stack = [(tree, iter(tree.children), [])]
+
+        while stack:
+            node, children, done = stack[-1]
+            for child in children:
+                if isinstance(child, tree_type):
+                    stack.append((child, iter(child.children), []))
+                    break
+                elif visit_tokens and isinstance(child, token_type):
+                    child = call_token(child)
+                    if child is discard:
+                        continue
+
+                done.append(child)
+            else:
+                stack.pop()
+                result = call_tree(node, done)
+                if not stack:
+                    return None if result is discard else result
+                elif result is not discard:
+                    stack[-1][2].append(result)
+
+        return None
+
     def _call_userfunc_token(self, token):
         """Call the user defined function for handling the given token.
 
@@ -12,7 +12,7 @@ import lark
 import pavilion.errors
 from pavilion import expression_functions as functions
 from pavilion.utils import auto_type_convert
-from .common import PavTransformer, ParserValueError
+from .common import PavTransformer, ParserValueError, parser_cache
 
 EXPR_GRAMMAR = r'''
 
@@ -24,18 +24,21 @@ start: expr _WS?
 // ignored below.
 _WS: /\s+/
 
-expr: or_expr
+// Rules prefixed with '?' are inlined (replaced by their child) when they
+// have only one child. Most expressions only use a few of the operator
+// levels below, so this keeps the parse trees (and transforming them) small.
+?expr: or_expr
 
 // These set order of operations. 
 // See https://en.wikipedia.org/wiki/Operator-precedence_parser
-or_expr: and_expr ( OR and_expr )*        
-and_expr: not_expr ( AND not_expr )*
-not_expr: NOT? compare_expr 
-compare_expr: add_expr ((EQ | NOT_EQ | LT | GT | LT_EQ | GT_EQ ) add_expr)*
-add_expr: mult_expr ((PLUS | MINUS) mult_expr)*
-mult_expr: pow_expr ((TIMES | DIVIDE | INT_DIV | MODULUS) pow_expr)*
-pow_expr: primary ("^" primary)?
-primary: literal 
+?or_expr: and_expr ( OR and_expr )*        
+?and_expr: not_expr ( AND not_expr )*
+?not_expr: NOT? compare_expr 
+?compare_expr: add_expr ((EQ | NOT_EQ | LT | GT | LT_EQ | GT_EQ ) add_expr)*
+?add_expr: mult_expr ((PLUS | MINUS) mult_expr)*
+?mult_expr: pow_expr ((TIMES | DIVIDE | INT_DIV | MODULUS) pow_expr)*
+?pow_expr: primary ("^" primary)?
+?primary: literal 
        | var_ref 
        | negative
        | "(" expr ")"
@@ -48,7 +51,7 @@ function_call: NAME "(" (expr ("," expr)*)? ")"
 negative: (MINUS|PLUS) primary
 
 // A literal value is just what it appears to be.
-literal: INTEGER
+?literal: INTEGER
        | FLOAT
        | BOOL
        | ESCAPED_STRING
@@ -59,7 +62,7 @@ list_: L_BRACKET (expr ("," expr)* ","?)? R_BRACKET
 // Variable references are kept generic. We'll use this both
 // for Pavilion string variables and result calculation variables.
 var_ref: NAME ("." var_key)*
-var_key: NAME
+?var_key: NAME
         | INTEGER
         | TIMES
 
@@ -113,7 +116,8 @@ def get_expr_parser(debug=False):
         parser = lark.Lark(
             grammar=EXPR_GRAMMAR,
             parser='lalr',
-            debug=debug
+            debug=debug,
+            cache=False if debug else parser_cache('expr'),
         )
     else:
         parser = _EXPR_PARSER
@@ -446,8 +450,7 @@ class BaseExprTransformer(PavTransformer):
         """
 
         # Ints are a series of digits, so this can't fail
-        tok.value = int(tok.value)
-        return tok
+        return lark.Token.new_borrow_pos(tok.type, int(tok.value), tok)
 
     def FLOAT(self, tok: lark.Token) -> lark.Token:
         """Convert to a float.
@@ -456,22 +459,19 @@ class BaseExprTransformer(PavTransformer):
         """
 
         # Similar to ints, this can't fail either.
-        tok.value = float(tok.value)
-        return tok
+        return lark.Token.new_borrow_pos(tok.type, float(tok.value), tok)
 
     def BOOL(self, tok: lark.Token) -> lark.Token:
         """Convert to a boolean."""
 
         # Assumes BOOL only matches 'True' or 'False'
-        tok.value = tok.value == 'True'
-
-        return tok
+        return lark.Token.new_borrow_pos(tok.type, tok.value == 'True', tok)
 
     def ESCAPED_STRING(self, tok: lark.Token) -> lark.Token:
         """Remove quotes from the given string."""
 
-        tok.value = ast.literal_eval('r' + tok.value)
-        return tok
+        return lark.Token.new_borrow_pos(
+            tok.type, ast.literal_eval('r' + tok.value), tok)
 
 
 class ExprTransformer(BaseExprTransformer):
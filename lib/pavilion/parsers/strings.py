@@ -8,9 +8,10 @@ String LALR Grammar
     {}
 """
 
+import functools
 from typing import List
 import lark
-from .common import ParserValueError, PavTransformer
+from .common import ParserValueError, PavTransformer, parser_cache
 from .expressions import get_expr_parser, ExprTransformer, VarRefVisitor
 
 STRING_GRAMMAR = r'''
@@ -75,6 +76,9 @@ __doc__ = __doc__.format('\n    '.join(STRING_GRAMMAR.split('\n')))
 
 _STRING_PARSER = None
 
+# The number of parsed expression trees to keep in memory.
+EXPR_TREE_CACHE_SIZE = 4096
+
 
 def get_string_parser(debug=False):
     """Return a string parser, from cache if possible."""
@@ -84,7 +88,8 @@ def get_string_parser(debug=False):
         parser = lark.Lark(
             grammar=STRING_GRAMMAR,
             parser='lalr',
-            debug=debug
+            debug=debug,
+            cache=False if debug else parser_cache('string'),
         )
     else:
         parser = _STRING_PARSER
@@ -95,6 +100,15 @@ def get_string_parser(debug=False):
     return parser
 
 
+@functools.lru_cache(maxsize=EXPR_TREE_CACHE_SIZE)
+def _parse_expr_text(text: str) -> lark.Tree:
+    """Parse the given expression text. The same expressions tend to appear
+    in many strings (and in every permutation of a test), so the trees are
+    cached. Transformers must not modify the trees they're given."""
+
+    return get_expr_parser().parse(text)
+
+
 def should_parse(text):
     """Returns true if text is a string that needs to be parsed. We err on the side of
     parsing some string unnecessarily, but this check is much faster than actually calling
@@ -103,7 +117,9 @@ def should_parse(text):
     if not text:
         return False
 
-    return '{{' in text or '[~' in text or '\\' in text or '}}' in text or '~' in text
+    # These are all simple substring searches, which are much faster than a
+    # regex. Note that the '~' check also covers iterations ('[~').
+    return '{{' in text or '}}' in text or '~' in text or '\\' in text
 
 
 class ExprToken(lark.Token):
@@ -167,9 +183,14 @@ class StringTransformer(PavTransformer):
             elif isinstance(item.value, dict):
                 token_list.append(item)
             else:
-                item.value = self._unescape(
-                    item.value, {'\\{{': '{{', '\\~': '~',
-                                 '\\\\{{': '\\{{', '\\\\~': '\\~'})
+                # Make a new token rather than modifying this one, as the
+                # parse tree may be cached and transformed again.
+                item = lark.Token.new_borrow_pos(
+                    item.type,
+                    self._unescape(
+                        item.value, {'\\{{': '{{', '\\~': '~',
+                                     '\\\\{{': '\\{{', '\\\\~': '\\~'}),
+                    item)
 
                 token_list.append(item)
 
@@ -321,7 +342,7 @@ class StringTransformer(PavTransformer):
         """Parse the given expression token and return the tree."""
 
         try:
-            return get_expr_parser().parse(expr.value['expr'])
+            return _parse_expr_text(expr.value['expr'])
         except ParserValueError as err:
             err.pos_in_stream += expr.start_pos
             # Re-raise the corrected error
@@ -87,7 +87,8 @@ def parse_evaluation_dict(eval_dict: Dict[str, str], results: dict,
             tree = parser.parse(expr)
         except (_lark.UnexpectedCharacters, _lark.UnexpectedToken) as err:
             # Try to figure out why the error happened based on examples.
-            err_type = match_examples(err, parser.parse, BAD_EXAMPLES, expr)
+            err_type = match_examples(err, parser.parse, BAD_EXAMPLES, expr,
+                                      cache_key='expr')
             log("Error parsing expression, failing.")
             log(err_type)
             log(err.get_context(expr))
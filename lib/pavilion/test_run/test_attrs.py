@@ -104,18 +104,15 @@ class TestAttributes:
 
         attr_path = self.path/self.ATTR_FILE_NAME
 
-        attrs = {}
-        if not attr_path.exists():
+        try:
+            attrs = json.loads(attr_path.read_bytes())
+        except FileNotFoundError:
             self._attrs = self.load_legacy_attributes()
             return
-
-        with attr_path.open() as attr_file:
-            try:
-                attrs = json.load(attr_file)
-            except (json.JSONDecodeError, OSError, ValueError, KeyError) as err:
-                raise TestRunError(
-                    "Could not load attributes file: \n{}"
-                    .format(err.args))
+        except (json.JSONDecodeError, OSError, ValueError, KeyError) as err:
+            raise TestRunError(
+                "Could not load attributes file: \n{}"
+                .format(err.args))
 
         for key, val in attrs.items():
             deserializer = self.deserializers.get(key)
@@ -406,12 +406,16 @@ class TestRun(TestAttributes):
 
         path = dir_db.make_id_path(working_dir / cls.RUN_DIR, test_id)
 
-        if not path.is_dir():
-            raise TestRunError("Test directory for test id {} does not exist "
-                               "at '{}' as expected."
-                               .format(test_id, path))
-
-        config = cls._load_config(path)
+        # Only stat the test directory when the config can't be read; on
+        # network filesystems every extra probe is another round trip.
+        try:
+            config = cls._load_config(path)
+        except TestRunError:
+            if not path.is_dir():
+                raise TestRunError(
+                    "Test directory for test id {} does not exist at '{}' as "
+                    "expected.".format(test_id, path))
+            raise
 
         test_run = TestRun(pav_cfg, config, _id=test_id)
         test_run.saved = True
@@ -512,15 +516,13 @@ class TestRun(TestAttributes):
         """Load a saved test configuration."""
         config_path = test_path/'config'
 
-        if not config_path.is_file():
+        try:
+            # Because only string keys are allowed in test configs,
+            # this is a reasonable way to load them.
+            return json.loads(config_path.read_bytes())
+        except (FileNotFoundError, IsADirectoryError):
             raise TestRunError("Could not find config file for test at {}."
                                .format(test_path))
-
-        try:
-            with config_path.open('r') as config_file:
-                # Because only string keys are allowed in test configs,
-                # this is a reasonable way to load them.
-                return json.load(config_file)
         except TypeError as err:
             raise TestRunError("Bad config values for config '{}': {}"
                                .format(config_path, err))
@@ -1,15 +1,34 @@
 """Utility functions for test run objects."""
 
+import heapq
+import os
+import weakref
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, TextIO
+from typing import List, TextIO, Tuple, Union
 
-from pavilion import dir_db, output
+from pavilion import output
 from pavilion.config import PavConfig
 from pavilion.errors import TestRunError
 from pavilion.types import ID_Pair
 from .test_run import TestRun
 
 
+# Below this many test directories, stat them serially rather than
+# spinning up a thread pool.
+THREADED_STAT_MIN = 32
+
+
+def _test_dir_mtime(entry: os.DirEntry) -> Union[Tuple[float, int], None]:
+    """Return a (mtime, test_id) tuple for the given test directory entry, or
+    None if it isn't a valid test directory."""
+
+    try:
+        test_id = int(entry.name)
+        return entry.stat().st_mtime, test_id
+    except (ValueError, OSError):
+        return None
+
+
 def get_latest_tests(pav_cfg: PavConfig, limit):
     """Returns ID's of latest test given a limit
 
@@ -19,21 +38,33 @@ def get_latest_tests(pav_cfg: PavConfig, limit):
 :rtype: list(int)
 """
 
-    test_dir_list = []
+    # Scan the run directories directly. The DirEntry objects know whether
+    # they're directories without an extra stat call per path.
+    test_dirs = []
     for config in pav_cfg.configs.values():
 
         runs_dir = config['working_dir']/TestRun.RUN_DIR
-        for test_dir in dir_db.select(pav_cfg, runs_dir).paths:
-            mtime = test_dir.stat().st_mtime
-            try:
-                test_id = int(test_dir.name)
-            except ValueError:
-                continue
+        try:
+            with os.scandir(runs_dir.as_posix()) as entries:
+                test_dirs.extend(entry for entry in entries if entry.is_dir())
+        except OSError:
+            continue
+
+    # Stat'ing is latency bound (especially on network filesystems), so
+    # do it in parallel when there are enough tests to make that worthwhile.
+    if len(test_dirs) < THREADED_STAT_MIN:
+        mtimes = [_test_dir_mtime(test_dir) for test_dir in test_dirs]
+    else:
+        with ThreadPoolExecutor(max_workers=pav_cfg['max_threads']) as pool:
+            mtimes = list(pool.map(_test_dir_mtime, test_dirs))
 
-            test_dir_list.append((mtime, test_id))
+    test_dir_list = [mtime for mtime in mtimes if mtime is not None]
 
-    test_dir_list.sort()
-    return [test_id for _, test_id in test_dir_list[-limit:]]
+    # Only the newest few are needed, so avoid sorting the whole list.
+    # These come out newest first, so flip them back to oldest first.
+    latest = heapq.nlargest(limit, test_dir_list)
+    latest.reverse()
+    return [test_id for _, test_id in latest]
 
 
 def _load_test(pav_cfg, id_pair: ID_Pair):
@@ -44,7 +75,12 @@ def _load_test(pav_cfg, id_pair: ID_Pair):
     return TestRun.load(pav_cfg, test_wd, test_id)
 
 
-LOADED_TESTS = {}
+# Complete tests that have already been loaded (and are still in use
+# elsewhere). Incomplete tests aren't kept, as their config and variables may
+# still be rewritten on disk (when they're finalized, for instance).
+# Holding weak references keeps long running processes from accumulating
+# every test they've ever loaded.
+LOADED_TESTS = weakref.WeakValueDictionary()
 
 
 def load_tests(pav_cfg, id_pairs: List[ID_Pair], errfile: TextIO) -> List['TestRun']:
@@ -56,25 +92,48 @@ def load_tests(pav_cfg, id_pairs: List[ID_Pair], errfile: TextIO) -> List['TestR
     tests = []
 
     # Only load tests that haven't already been loaded.
+    # The set is for fast membership checks, the list preserves order.
     not_loaded = []
+    not_loaded_set = set()
     for pair in id_pairs:
-        if pair in LOADED_TESTS:
-            tests.append(LOADED_TESTS[pair])
-        elif pair not in not_loaded:
+        # Fetch rather than check membership, as the entry may vanish
+        # between the two.
+        test = LOADED_TESTS.get(pair)
+        if test is not None:
+            # Attributes can change even after a test is complete (when its
+            # results are re-run, for instance), so refresh them.
+            try:
+                test.load_attributes()
+            except TestRunError as err:
+                output.fprint(errfile, "Error loading test: {}".format(err.args[0]),
+                              color=output.YELLOW)
+                continue
+            tests.append(test)
+        elif pair not in not_loaded_set:
+            not_loaded_set.add(pair)
             not_loaded.append(pair)
 
     id_filtered_pairs = not_loaded
 
+    # Threads are used rather than processes on purpose. Test configs are
+    # JSON (decoded in C), and the loaded TestRun objects carry the pav_cfg,
+    # builders, and plugin state. Pickling those back from worker processes
+    # would cost more than loading them here.
     with ThreadPoolExecutor(max_workers=pav_cfg['max_threads']) as pool:
         results = []
         for pair in id_filtered_pairs:
             results.append(pool.submit(_load_test, pav_cfg, pair))
 
-        for result in results:
+        for pair, result in zip(id_filtered_pairs, results):
             try:
-                tests.append(result.result())
+                test = result.result()
             except TestRunError as err:
                 output.fprint(errfile, "Error loading test: {}".format(err.args[0]),
                               color=output.YELLOW)
+                continue
+
+            tests.append(test)
+            if test.complete:
+                LOADED_TESTS[pair] = test
 
     return tests
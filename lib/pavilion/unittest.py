@@ -1,16 +1,23 @@
 """This module provides a base set of utilities for creating unittests
 for Pavilion."""
 
+import atexit
 import copy
+import filecmp
 import fnmatch
 import inspect
+import itertools
+import json
 import os
-import pprint
+import re
+import shutil
+import sys
 import tempfile
 import time
 import types
 import unittest
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 from pathlib import Path
 from typing import List
@@ -24,11 +31,16 @@ from pavilion import pavilion_variables
 from pavilion import plugins
 from pavilion.sys_vars import base_classes
 from pavilion.output import dbg_print
+from pavilion.parsers import common as parser_common
 from pavilion.variables import VariableSetManager
-from pavilion.resolver import TestConfigResolver
 from pavilion.test_config.file_format import TestConfigLoader
 from pavilion.test_run import TestRun
 
+# Keep the parser caches made while testing out of the user's cache directory.
+parser_common.CACHE_DIR = Path(tempfile.mkdtemp(prefix='pav_parser_cache_'))
+atexit.register(shutil.rmtree, parser_common.CACHE_DIR.as_posix(),
+                ignore_errors=True)
+
 
 class PavTestCase(unittest.TestCase):
     """A unittest.TestCase with a lot of useful Pavilion features baked in.
@@ -65,6 +77,12 @@ base class.
     SKIP = []
     # Only run tests that match these globs.
     ONLY = []
+    # The SKIP and ONLY globs, each compiled into a single regex.
+    _SKIP_RE = None
+    _ONLY_RE = None
+    # Whether each (test class, test method name) is skipped under the
+    # current SKIP/ONLY globs. Reset when those are set.
+    _SKIP_DECISIONS = {}
 
     # Working dirs
     WORKING_DIRS = [
@@ -74,6 +92,19 @@ base class.
         'users',
         ]
 
+    # Pavilion configs are the same for every test instance, so they're only
+    # loaded (and written out for the test's use) once per set of config dirs.
+    # The raw configs are keyed by the path and mtime of the source config.
+    _RAW_CFG_CACHE = {}
+    _PAV_CFG_CACHE = {}
+
+    # Plugins are normally initialized once per test class, and reset after
+    # the last test in it. Set this in test classes whose tests change the
+    # plugin state to get a fresh plugin system for every test.
+    PLUGINS_PER_TEST = False
+    # Whether set_up has initialized plugins for this (specific) test class.
+    plugins_inited = False
+
     def __init__(self, *args, **kwargs):
         """Setup the pav_cfg object, and do other initialization required by
         pavilion."""
@@ -81,7 +112,9 @@ base class.
         self.pav_cfg: config.PavConfig = self.make_pav_config()
 
         # We have to get this to set up the base argument parser before
-        # plugins can add to it.
+        # plugins can add to it. The parser is only built once (until
+        # arguments.reset_parser() is called), so this is cheap for every
+        # test instance after the first.
         _ = arguments.get_parser()
         super().__init__(*args, **kwargs)
 
@@ -93,19 +126,34 @@ base class.
         self.tear_down()
 
     def set_up(self):
-        """By default, initialize plugins before every test."""
-
-        _ = self
+        """By default, initialize plugins once for each test class. Set
+        PLUGINS_PER_TEST to initialize (and reset) them for every test."""
 
-        plugins.initialize_plugins(self.pav_cfg)
+        cls = type(self)
+        if self.PLUGINS_PER_TEST or not cls.__dict__.get('plugins_inited'):
+            plugins.initialize_plugins(self.pav_cfg)
+            cls.plugins_inited = True
 
     def tear_down(self):
-        """By default, reset plugins after every test."""
+        """Reset plugins after the test if they're initialized per test, or
+        weren't initialized by our own set_up (a subclass did it)."""
+
+        if (self.PLUGINS_PER_TEST
+                or not type(self).__dict__.get('plugins_inited')):
+            # pylint: disable=protected-access
+            plugins._reset_plugins()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Reset any plugins left initialized by set_up, so the next test
+        class starts with a clean plugin system."""
 
-        _ = self
+        if cls.__dict__.get('plugins_inited'):
+            # pylint: disable=protected-access
+            plugins._reset_plugins()
+            cls.plugins_inited = False
 
-        # pylint: disable=protected-access
-        plugins._reset_plugins()
+        super().tearDownClass()
 
     def make_pav_config(self, config_dirs: List[Path] = None):
         """Create a pavilion config for use with tests. By default uses the `data/pav_config_dir`
@@ -115,11 +163,34 @@ base class.
         if config_dirs is None:
             config_dirs = [self.TEST_DATA_ROOT / 'pav_config_dir']
 
+        raw_key = (self.PAV_CONFIG_PATH, self.PAV_CONFIG_PATH.stat().st_mtime_ns)
+        cfg_key = raw_key + (tuple(config_dirs),)
+
+        pav_cfg = self._PAV_CFG_CACHE.get(cfg_key)
+        # The written out config file must still exist, as it's handed to
+        # any Pavilion sub-processes that tests kick off.
+        if pav_cfg is None or not os.path.exists(str(pav_cfg.pav_cfg_file)):
+            pav_cfg = self._make_pav_config(raw_key, config_dirs)
+            self._PAV_CFG_CACHE[cfg_key] = pav_cfg
+
+        # Tests are allowed to modify their config, so always hand out a copy.
+        pav_cfg = copy.deepcopy(pav_cfg)
+        pav_cfg.pav_vars = pavilion_variables.PavVars()
+
+        return pav_cfg
+
+    def _make_pav_config(self, raw_key, config_dirs: List[Path]):
+        """Create a new pavilion config using the given config dirs. The raw
+        config is loaded once for each raw_key."""
+
         # Open the default pav config file (found in
         # test/data/pav_config_dir/pavilion.yaml), modify it, and then
         # save the modified file to a temp location and read it instead.
-        with self.PAV_CONFIG_PATH.open() as cfg_file:
-            raw_pav_cfg = config.PavilionConfigLoader().load(cfg_file)
+        if raw_key not in self._RAW_CFG_CACHE:
+            with self.PAV_CONFIG_PATH.open() as cfg_file:
+                self._RAW_CFG_CACHE[raw_key] = config.PavilionConfigLoader().load(cfg_file)
+
+        raw_pav_cfg = copy.deepcopy(self._RAW_CFG_CACHE[raw_key])
 
         raw_pav_cfg.config_dirs = config_dirs
 
@@ -128,98 +199,141 @@ base class.
 
         raw_pav_cfg.result_log = raw_pav_cfg.working_dir/'results.log'
 
-        if not raw_pav_cfg.working_dir.exists():
-            raw_pav_cfg.working_dir.mkdir()
-
         cfg_dir = raw_pav_cfg.working_dir/'pav_cfgs'
-        if not cfg_dir.exists():
-            cfg_dir.mkdir()
+        os.makedirs(str(cfg_dir), exist_ok=True)
 
-        cfg_path = Path(tempfile.mktemp(
-            suffix='.yaml',
-            dir=str(cfg_dir)))
-
-        with cfg_path.open('w') as pav_cfg_file:
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', dir=str(cfg_dir),
+                                         delete=False) as pav_cfg_file:
             config.PavilionConfigLoader().dump(pav_cfg_file,
                                                raw_pav_cfg)
+        cfg_path = Path(pav_cfg_file.name)
 
-        pav_cfg = config.find_pavilion_config(target=cfg_path, warn=False)
-        pav_cfg.pav_vars = pavilion_variables.PavVars()
+        # The config file is shared by every test that uses this config, and
+        # is handed to any sub-processes they start, so it can't be removed
+        # until we're done.
+        atexit.register(self._remove_cfg_file, cfg_path)
 
-        return pav_cfg
+        return config.find_pavilion_config(target=cfg_path, warn=False)
+
+    @staticmethod
+    def _remove_cfg_file(cfg_path: Path):
+        """Remove a generated pavilion config file, if it still exists."""
+
+        try:
+            cfg_path.unlink()
+        except OSError:
+            pass
 
     def __getattribute__(self, item):
         """Override the builtin __getattribute__ so that tests skipped via command line
         options are properly 'wrapped'."""
-        attr = super().__getattribute__(item)
 
-        cls = super().__getattribute__('__class__')
-        cname = cls.__name__.lower()
-        fname = Path(inspect.getfile(cls)).with_suffix('').name.lower()
+        # This runs for every attribute lookup on a test, so get anything
+        # that couldn't be a test method out of the way first.
+        if not item.startswith('test_'):
+            return super().__getattribute__(item)
+
+        attr = super().__getattribute__(item)
 
         # Wrap our test functions in a function that dynamically wraps
         # them so they only execute under certain conditions.
         if (isinstance(attr, types.MethodType) and
                 attr.__name__.startswith('test_')):
 
-            name = attr.__name__[len('test_'):].lower()
-
-            if self.SKIP:
-                for skip_glob in self.SKIP:
-                    skip_glob = skip_glob.lower()
-                    if (fnmatch.fnmatch(name, skip_glob) or
-                            fnmatch.fnmatch(cname, skip_glob) or
-                            fnmatch.fnmatch(fname, skip_glob)):
-                        return unittest.skip("via cmdline")(attr)
-                return attr
-
-            if self.ONLY:
-                for only_glob in self.ONLY:
-                    only_glob = only_glob.lower()
-                    if (fnmatch.fnmatch(name, only_glob) or
-                            fnmatch.fnmatch(cname, only_glob) or
-                            fnmatch.fnmatch(fname, only_glob)):
-                        return attr
+            cls = super().__getattribute__('__class__')
+            key = (cls, attr.__name__)
+            skip = PavTestCase._SKIP_DECISIONS.get(key)
+            if skip is None:
+                skip = cls._skip_test(attr.__name__)
+                PavTestCase._SKIP_DECISIONS[key] = skip
+
+            if skip:
                 return unittest.skip("via cmdline")(attr)
 
         # If it isn't altered or explicitly returned above, just return the
         # attribute.
         return attr
 
+    @classmethod
+    def _skip_test(cls, test_name: str) -> bool:
+        """Return whether the given test method should be skipped according
+        to the SKIP and ONLY globs."""
+
+        # The lower-cased class and file names are cached on each class.
+        # Check the class's own __dict__ so subclasses don't inherit them.
+        names = cls.__dict__.get('_skip_names')
+        if names is None:
+            names = (cls.__name__.lower(),
+                     Path(inspect.getfile(cls)).with_suffix('').name.lower())
+            cls._skip_names = names
+        cname, fname = names
+        name = test_name[len('test_'):].lower()
+
+        if cls.SKIP:
+            if cls._SKIP_RE is None:
+                cls._SKIP_RE = cls._compile_globs(cls.SKIP)
+            skip_re = cls._SKIP_RE
+            return bool(skip_re.match(name) or skip_re.match(cname) or
+                        skip_re.match(fname))
+
+        if cls.ONLY:
+            if cls._ONLY_RE is None:
+                cls._ONLY_RE = cls._compile_globs(cls.ONLY)
+            only_re = cls._ONLY_RE
+            return not (only_re.match(name) or only_re.match(cname) or
+                        only_re.match(fname))
+
+        return False
+
+    @staticmethod
+    def _compile_globs(globs):
+        """Compile the given globs into a single (lower case) regex that
+        matches anything any of the globs would."""
+
+        return re.compile('|'.join(
+            '(?:{})'.format(fnmatch.translate(glob.lower())) for glob in globs))
+
     @classmethod
     def set_skip(cls, globs):
         """Skip tests whose names match the given globs."""
 
         cls.SKIP = globs
+        cls._SKIP_RE = cls._compile_globs(globs)
+        PavTestCase._SKIP_DECISIONS.clear()
 
     @classmethod
     def set_only(cls, globs):
         """Only run tests whos names match the given globs."""
         cls.ONLY = globs
+        cls._ONLY_RE = cls._compile_globs(globs)
+        PavTestCase._SKIP_DECISIONS.clear()
 
     def _is_softlink_dir(self, path):
         """Verify that a directory contains nothing but softlinks whose files
 exist. Directories in a softlink dir should be real directories
 though."""
 
-        for base_dir, cdirs, cfiles in os.walk(str(path)):
-            base_dir = Path(base_dir)
-            for cdir in cdirs:
-                self.assert_((base_dir/cdir).is_dir(),
-                             "Directory in softlink dir is a softlink (it "
-                             "shouldn't be).")
-
-            for file in cfiles:
-                file_path = base_dir/file
-                self.assert_(file_path.is_symlink(),
-                             "File in softlink dir '{}' is not a softlink."
-                             .format(file_path))
-
-                target_path = file_path.resolve()
-                self.assert_(target_path.exists(),
-                             "Softlink target '{}' for link '{}' does not "
-                             "exist."
-                             .format(target_path, file_path))
+        # Scandir entries already know whether they're links (or real
+        # directories), so this only needs to stat each link target.
+        dirs = [str(path)]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                        continue
+
+                    self.assertTrue(entry.is_symlink(),
+                                    "File in softlink dir '{}' is not a "
+                                    "softlink.".format(entry.path))
+
+                    # This also catches link loops and other bad links.
+                    try:
+                        os.stat(entry.path)
+                    except OSError as err:
+                        self.fail("Softlink target for link '{}' does not "
+                                  "exist or can't be reached: {}"
+                                  .format(entry.path, err))
 
     def _cmp_files(self, a_path, b_path):
         """Compare the contents of two files.
@@ -228,37 +342,54 @@ though."""
         :param Path b_path:
         """
 
-        with a_path.open('rb') as a_file, b_path.open('rb') as b_file:
-            self.assertEqual(a_file.read(), b_file.read(),
-                             "File contents mismatch for {} and {}."
-                             .format(a_path, b_path))
+        self.assertTrue(self._files_match(a_path, b_path),
+                        "File contents mismatch for {} and {}."
+                        .format(a_path, b_path))
+
+    @staticmethod
+    def _files_match(a_path, b_path) -> bool:
+        """Return whether the two files have the same contents. This compares
+        the files in blocks, rather than reading the (possibly huge) files
+        whole."""
+
+        return filecmp.cmp(str(a_path), str(b_path), shallow=False)
+
+    @staticmethod
+    def _sorted_walk(path):
+        """Walk the given directory like os.walk, but in a deterministic
+        (sorted) order. The directory and file lists are sorted in place."""
+
+        for base_dir, cdirs, cfiles in os.walk(str(path)):
+            # Sorting cdirs in place also sets the order os.walk descends in.
+            cdirs.sort()
+            cfiles.sort()
+            yield base_dir, cdirs, cfiles
 
     def _cmp_tree(self, path_a, path_b):
         """Compare two directory trees, including the contents of all the
         files."""
 
-        a_walk = list(os.walk(str(path_a)))
-        b_walk = list(os.walk(str(path_b)))
-
-        # Make sure these are in the same order.
-        a_walk.sort()
-        b_walk.sort()
-
-        while a_walk and b_walk:
-            a_dir, a_dirs, a_files = a_walk.pop(0)
-            b_dir, b_dirs, b_files = b_walk.pop(0)
+        # Walk both trees in lockstep. Since both walks are sorted and
+        # each step checks that the subdirectories match, the two walks
+        # visit corresponding directories at each step.
+        walks = itertools.zip_longest(self._sorted_walk(path_a),
+                                      self._sorted_walk(path_b))
+        file_pairs = []
+        for a_walk, b_walk in walks:
+            self.assertTrue(a_walk is not None and b_walk is not None,
+                            "Left over directory contents in a or b: {}, {}"
+                            .format(a_walk, b_walk))
+
+            a_dir, a_dirs, a_files = a_walk
+            b_dir, b_dirs, b_files = b_walk
             a_dir = Path(a_dir)
             b_dir = Path(b_dir)
 
             self.assertEqual(
-                sorted(a_dirs), sorted(b_dirs),
+                a_dirs, b_dirs,
                 "Extracted archive subdir mismatch for '{}' {} != {}"
                 .format(path_a, a_dirs, b_dirs))
 
-            # Make sure these are in the same order.
-            a_files.sort()
-            b_files.sort()
-
             self.assertEqual(a_files, b_files,
                              "Extracted archive file list mismatch. "
                              "{} != {}".format(a_files, b_files))
@@ -269,14 +400,25 @@ though."""
                 b_path = b_dir/file
 
                 # We know the file exists in a, does it in b?
-                self.assert_(b_path.exists(),
-                             "File missing from archive b '{}'".format(b_path))
+                self.assertTrue(b_path.exists(),
+                                "File missing from archive b '{}'"
+                                .format(b_path))
 
-                self._cmp_files(a_path, b_path)
+                file_pairs.append((a_path, b_path))
 
-        self.assert_(not a_walk and not b_walk,
-                     "Left over directory contents in a or b: {}, {}"
-                     .format(a_walk, b_walk))
+        # The file comparisons are independent and IO bound, so overlap them.
+        with ThreadPoolExecutor(max_workers=self.pav_cfg['max_threads']) as pool:
+            matches = pool.map(self._files_match,
+                               [a_path for a_path, _ in file_pairs],
+                               [b_path for _, b_path in file_pairs])
+
+            for (a_path, b_path), match in zip(file_pairs, matches):
+                self.assertTrue(match,
+                                "File contents mismatch for {} and {}."
+                                .format(a_path, b_path))
+
+    # Chunk size when reading and hashing files.
+    _HASH_BLOCK_SIZE = 1024*1024
 
     @staticmethod
     def get_hash(filename):
@@ -288,7 +430,10 @@ though."""
         """
         with filename.open('rb') as file:
             sha = sha1()
-            sha.update(file.read())
+            chunk = file.read(PavTestCase._HASH_BLOCK_SIZE)
+            while chunk:
+                sha.update(chunk)
+                chunk = file.read(PavTestCase._HASH_BLOCK_SIZE)
             return sha.hexdigest()
 
     dbg_print = staticmethod(dbg_print)
@@ -313,6 +458,9 @@ though."""
         'schedule': {},
     }
 
+    # Parsed local scheduler settings, keyed by path and mtime.
+    _LOCAL_SCHED_CACHE = {}
+
     def _quick_test_cfg(self):
         """Return a pre-populated test config to use with
 ``self._quick_test``. This can be used as is, or modified for
@@ -323,17 +471,24 @@ The default config is: ::
 {}
 """
 
-        cfg = copy.deepcopy(self.QUICK_TEST_BASE_CFG)
+        # The base config is plain data, so a JSON round trip is a much
+        # quicker deep copy than copy.deepcopy.
+        cfg = json.loads(json.dumps(self.QUICK_TEST_BASE_CFG))
 
         loc_sched = (self.TEST_DATA_ROOT/'pav_config_dir'/'modes' /
                      'local_sched.yaml')
 
         if loc_sched.exists():
-            with loc_sched.open() as loc_slurm_file:
-                sched_cfg = TestConfigLoader().load(loc_slurm_file,
-                                                    partial=True)
+            # Only parse the (unchanging) local scheduler config once.
+            sched_key = (loc_sched, loc_sched.stat().st_mtime_ns)
+            if sched_key not in self._LOCAL_SCHED_CACHE:
+                with loc_sched.open() as loc_slurm_file:
+                    sched_cfg = TestConfigLoader().load(loc_slurm_file,
+                                                        partial=True)
+                self._LOCAL_SCHED_CACHE[sched_key] = sched_cfg['schedule']
 
-            cfg['schedule'].update(sched_cfg['schedule'])
+            cfg['schedule'].update(
+                copy.deepcopy(self._LOCAL_SCHED_CACHE[sched_key]))
 
         return cfg
 
@@ -343,6 +498,11 @@ The default config is: ::
         """Load the named test config from file. Returns a list of the
         resulting configs."""
 
+        # The resolver isn't otherwise needed by most tests, so only import
+        # it when it's used.
+        # pylint: disable=import-outside-toplevel
+        from pavilion.resolver import TestConfigResolver
+
         if modes is None:
             modes = []
 
@@ -370,7 +530,15 @@ The default config is: ::
 
         return tests
 
-    __config_lines = pprint.pformat(QUICK_TEST_BASE_CFG).split('\n')
+    # Pretty printing the default config into the docstring is only worth
+    # the (import time) trouble when building the documentation.
+    if 'sphinx' in sys.modules:
+        # pylint: disable=import-outside-toplevel
+        import pprint
+        __config_lines = pprint.pformat(QUICK_TEST_BASE_CFG).split('\n')
+        del pprint
+    else:
+        __config_lines = ['See ``PavTestCase.QUICK_TEST_BASE_CFG``.']
     # Code analysis indicating format isn't found for 'bytes' is a Pycharm bug.
     _quick_test_cfg.__doc__ = _quick_test_cfg.__doc__.format(
         '\n'.join(['    ' + line for line in __config_lines]))
@@ -390,8 +558,9 @@ The default config is: ::
 
         if cfg is None:
             cfg = self._quick_test_cfg()
-
-        cfg = copy.deepcopy(cfg)
+        else:
+            # Don't modify the caller's config.
+            cfg = copy.deepcopy(cfg)
 
         loader = TestConfigLoader()
         cfg = loader.validate(loader.normalize(cfg))
@@ -429,6 +598,10 @@ The default config is: ::
             test.finalize(fin_var_man)
         return test
 
+    # The range of sleep times (in seconds) between checks in wait_tests.
+    WAIT_PERIOD_MIN = 0.01
+    WAIT_PERIOD_MAX = 0.1
+
     def wait_tests(self, working_dir: Path, timeout=5):
         """Wait on all the tests under the given path to complete.
 
@@ -439,29 +612,33 @@ The default config is: ::
         def is_complete(path: Path):
             """Return True if test is complete."""
 
-            return (path/TestRun.COMPLETE_FN).exists()
+            return os.path.exists(os.path.join(str(path), TestRun.COMPLETE_FN))
 
         runs_dir = working_dir / 'test_runs'
+        # The set of tests doesn't change while we wait, so only find them
+        # once and then just check the ones that haven't completed yet.
+        pending = set(dir_db.select(self.pav_cfg, runs_dir).paths)
+        if not pending:
+            self.fail("No tests started.")
+
         end_time = time.time() + timeout
+        # Start with short sleeps so quick tests are noticed right away, and
+        # back off to the max period for tests that take a while.
+        wait_period = self.WAIT_PERIOD_MIN
         while time.time() < end_time:
 
-            completed = [is_complete(test)
-                         for test in dir_db.select(self.pav_cfg, runs_dir).paths]
-
-            if not completed:
-                self.fail("No tests started.")
+            pending = {test for test in pending if not is_complete(test)}
 
-            if all(completed):
+            if not pending:
                 break
             else:
-                time.sleep(0.1)
+                time.sleep(min(wait_period, max(end_time - time.time(), 0)))
+                wait_period = min(wait_period * 2, self.WAIT_PERIOD_MAX)
                 continue
         else:
             raise TimeoutError(
                 "Waiting on tests: {}"
-                .format(test.name for test in dir_db.select(self.pav_cfg,
-                                                            runs_dir).paths
-                        if is_complete(test)))
+                .format(', '.join(sorted(test.name for test in pending))))
 
 
 class ColorResult(unittest.TextTestResult):
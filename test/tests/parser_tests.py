@@ -1,5 +1,7 @@
 """Tests for the various Pavilion parsers."""
 
+import pickle
+
 import lark
 
 from pavilion import plugins
@@ -333,3 +335,93 @@ class ParserTests(unittest.PavTestCase):
                 self.fail(
                     "Failed to fail on '{}', parsed to: '{}'"
                     .format(string, result))
+
+    def test_tree_cache(self):
+        """Check that parse trees are saved to and loaded from the on-disk
+        cache."""
+
+        orig_dir = parsers.common.CACHE_DIR
+        parsers.common.CACHE_DIR = self.pav_cfg.working_dir/'tree_cache'
+        cache_path = parsers._tree_cache_path()
+        # Start from empty caches, so the tree is actually parsed.
+        parsers._DISK_TREES = {}
+        parsers._get_tree.cache_clear()
+        try:
+            text = 'cached {{ int1 + 1 }} [~{{more_ints}}~_]'
+            self.assertEqual(parsers.parse_text(text, self.var_man), 'cached 2 0_1')
+            parsers._save_tree_cache()
+
+            trees = parsers._load_tree_cache(cache_path)
+            self.assertIn(text, trees)
+
+            # Cache files that others could have written are ignored.
+            cache_path.chmod(0o666)
+            self.assertEqual(parsers._load_tree_cache(cache_path), {})
+            cache_path.chmod(0o600)
+
+            # A cache made with a different grammar is ignored.
+            with cache_path.open('wb') as cache_file:
+                pickle.dump({'grammar': 'nope', 'trees': trees}, cache_file)
+            self.assertEqual(parsers._load_tree_cache(cache_path), {})
+        finally:
+            parsers.common.CACHE_DIR = orig_dir
+            parsers._DISK_TREES = None
+
+    def test_state_stack_dist(self):
+        """Check the state stack distance examples from the docstring."""
+
+        self.assertEqual(parsers._state_stack_dist('fuzzy', 'navel'), 5)
+        self.assertEqual(parsers._state_stack_dist('abcd', 'acd'), 1)
+        self.assertEqual(parsers._state_stack_dist('abcd', 'dcba'), 3)
+        self.assertEqual(parsers._state_stack_dist([1, 2, 1, 3], [1, 1, 3]), 1)
+        self.assertEqual(parsers.state_stack_dist([], []), 0)
+
+    def test_should_parse(self):
+        """Check the quick test for whether a string needs parsing."""
+
+        for text in ('{{foo}}', 'foo}}', '[~a~]', '~', 'back\\slash'):
+            self.assertTrue(parsers.should_parse(text), msg=text)
+
+        for text in ('', 'true', '/usr/bin/foo', '${HOME}', '[0-9]', 'a{b}c'):
+            self.assertFalse(parsers.should_parse(text), msg=text)
+
+    def test_value_cache(self):
+        """Check that cached string values track the variables they use."""
+
+        var_man2 = variables.VariableSetManager()
+        var_man2.add_var_set('var', {'int1': '5', 'more_ints': ['7']})
+
+        for text, expected, expected2 in (
+                ('n={{int1}}', 'n=1', 'n=5'),
+                ('[~{{more_ints}}~_]', '0_1', '7'),
+                (r'esc \{{ {{int1:03d}}', 'esc {{ 001', 'esc {{ 005')):
+            for _ in range(2):
+                self.assertEqual(parsers.parse_text(text, self.var_man), expected)
+                self.assertEqual(parsers.parse_text(text, var_man2), expected2)
+
+        # Strings that call functions are never cached.
+        self.assertIsNone(parsers._value_cache_key(
+            '{{random()}}', parsers.get_string_parser().parse('{{random()}}'),
+            self.var_man))
+
+    def test_iterative_transform(self):
+        """The non-recursive transform should give the same results as
+        lark's own recursive one."""
+
+        for text in ('hi {{int1 + 2 * (3 - int2) ^ 2}} [~{{ints}}~, ]',
+                     '[~{{more_ints}}-{{floats:0.2f}}~_] \\{{ end'):
+            tree = parsers.get_string_parser().parse(text)
+            self.assertEqual(
+                parsers.StringTransformer(self.var_man).transform(tree),
+                lark.Transformer.transform(
+                    parsers.StringTransformer(self.var_man), tree))
+
+    def test_expr_tree_cache(self):
+        """Cached expression trees must survive being transformed repeatedly."""
+
+        text = '{{ 2 * int1 + 1.5 }} {{ True and "a\\"b" == "a\\"b" }}'
+        tree = parsers.get_string_parser().parse(text)
+        for _ in range(3):
+            self.assertEqual(
+                parsers.StringTransformer(self.var_man).transform(tree),
+                '3.5 True')
@@ -15,6 +15,10 @@ from pavilion.unittest import PavTestCase
 class SchedTests(PavTestCase):
     """Assorted tests to apply across all scheduler plugins."""
 
+    # These tests dig into the node lists and chunks the scheduler plugins
+    # accumulate, so give each test fresh plugins.
+    PLUGINS_PER_TEST = True
+
     def test_check_examples(self):
         """Make sure scheduler examples are up-to-date."""
 
@@ -1,9 +1,11 @@
 """Test the 'TestRun' object'"""
 
+import gc
 import io
 
 from pavilion.errors import TestRunError
 from pavilion.test_run import TestRun
+from pavilion.test_run import utils as test_run_utils
 from pavilion.unittest import PavTestCase
 from pavilion.variables import VariableSetManager
 
@@ -200,3 +202,32 @@ class TestRunTests(PavTestCase):
         cmp_file = self.TEST_DATA_ROOT / 'create_files_results' / 'tmpl1.txt'
         self.assertTrue(test_file.is_symlink())
         self.assertEqual(test_file.open().read(), cmp_file.open().read())
+
+    def test_load_tests_cache(self):
+        """Check that loaded complete tests are reused while they're still
+        around."""
+
+        test = self._quick_test(build=False, finalize=False)
+        errfile = io.StringIO()
+
+        # Incomplete tests may still change on disk, so they aren't kept.
+        tests = test_run_utils.load_tests(self.pav_cfg, [test.id_pair], errfile)
+        self.assertEqual(len(tests), 1)
+        self.assertNotIn(test.id_pair, test_run_utils.LOADED_TESTS)
+
+        test.set_run_complete()
+        tests = test_run_utils.load_tests(self.pav_cfg, [test.id_pair], errfile)
+        self.assertEqual(len(tests), 1)
+        self.assertIn(test.id_pair, test_run_utils.LOADED_TESTS)
+
+        # Changes made by other processes should still show up.
+        test.user = 'someone_else'
+        test.save_attributes()
+        tests2 = test_run_utils.load_tests(self.pav_cfg, [test.id_pair], errfile)
+        self.assertIs(tests[0], tests2[0])
+        self.assertEqual(tests2[0].user, 'someone_else')
+
+        del tests, tests2
+        gc.collect()
+        self.assertNotIn(test.id_pair, test_run_utils.LOADED_TESTS)
+        self.assertEqual(errfile.getvalue(), '')